@@ -1,63 +1,156 @@
 import argparse
 import json
+import multiprocessing
+import os
 import sys
+import threading
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
-from typing import Any, Iterable, NewType
+from typing import Any, Iterable, Iterator, NewType, TextIO
 
+import cv2
+import numpy as np
 import rawpy
-import imagehash
 import vptree
-from PIL import Image
+from PIL import Image, ImageOps
 from tqdm import tqdm
 
 
 class ImageHashTable:
+    # Hashes are kept in a contiguous uint64 array with the file sets in a parallel list, so the searches
+    # can work on the packed hashes directly. The index maps a hash to its position in both.
     def __init__(self) -> None:
-        self.__image_hashes = defaultdict(set)
+        self.__hashes = np.empty(0, dtype=np.uint64)
+        self.__files: list[set[str]] = []
+        self.__index: dict[int, int] = {}
+
+    def __append(self, key: int, values: set[str]) -> None:
+        size = len(self.__files)
+        if size == len(self.__hashes):
+            # Grow geometrically to keep appending amortized O(1)
+            grown = np.empty(max(16, 2 * size), dtype=np.uint64)
+            grown[:size] = self.__hashes
+            self.__hashes = grown
+
+        self.__hashes[size] = key
+        self.__files.append(values)
+        self.__index[key] = size
+
+    def __getitem__(self, key: int) -> set[str]:
+        index = self.__index.get(key)
+        if index is None:
+            self.__append(key, set())
+            return self.__files[-1]
+        return self.__files[index]
+
+    def __setitem__(self, key: int, values: set[str]) -> None:
+        index = self.__index.get(key)
+        if index is None:
+            self.__append(key, values)
+        else:
+            self.__files[index] = values
 
-    @property
-    def hashes(self) -> dict[imagehash.ImageHash, set[Path]]:
-        return self.__image_hashes
+    def __contains__(self, key: int) -> bool:
+        return key in self.__index
 
-    def __getitem__(self, key: imagehash.ImageHash) -> set[Path]:
-        return self.__image_hashes[key]
+    def keys(self) -> Iterable[int]:
+        return self.packed().tolist()
 
-    def __setitem__(self, key: imagehash.ImageHash, values: set[Path]) -> None:
-        self.__image_hashes[key] = values
+    def items(self) -> Iterable[tuple[int, set[str]]]:
+        return zip(self.keys(), self.__files)
 
-    def keys(self) -> Iterable[imagehash.ImageHash]:
-        return self.__image_hashes.keys()
+    def __len__(self) -> int:
+        return len(self.__files)
 
-    def items(self) -> Iterable[tuple[imagehash.ImageHash, set[Path]]]:
-        return self.__image_hashes.items()
+    def packed(self) -> np.ndarray:
+        return self.__hashes[: len(self.__files)]
+
+    @property
+    def files(self) -> list[set[str]]:
+        return self.__files
 
     def update(self, other: "ImageHashTable") -> None:
-        for entry_hash, entry_files in other.__image_hashes.items():
-            self.__image_hashes[entry_hash] |= entry_files
+        # Merging into an empty table needs no unions, copy the file sets so later merges don't modify the other table
+        if not self.__files:
+            self.__hashes = other.packed().copy()
+            self.__files = [files.copy() for files in other.__files]
+            self.__index = other.__index.copy()
+            return
+
+        for entry_hash, entry_files in other.items():
+            self[entry_hash] |= entry_files
 
     def __str__(self) -> str:
         result = ""
-        for image_hash, files in self.__image_hashes.items():
-            result += f"{image_hash}\n"
+        for image_hash, files in self.items():
+            result += f"{hash_to_hex(image_hash)}\n"
             for f in files:
                 result += f"    {f}\n"
         return result
 
 
-DoppelgaengerList = NewType("DoppelgaengerList", dict[Path, set[Path]])
+DoppelgaengerList = NewType("DoppelgaengerList", dict[str, set[str]])
 
 
-RAW_EXTENSIONS = {".nef", ".cr2", ".arw", ".dng", ".orf", ".rw2"}
+RAW_EXTENSIONS = frozenset({".nef", ".cr2", ".arw", ".dng", ".orf", ".rw2"})
+JPEG_EXTENSIONS = frozenset({".jpg", ".jpeg", ".jpe", ".jfif"})
+IMAGE_EXTENSIONS = JPEG_EXTENSIONS | RAW_EXTENSIONS | {".png", ".webp", ".tif", ".tiff", ".bmp", ".gif", ".jp2"}
 EPSILON = 0.01
+HASHING_CHUNKS_PER_WORKER = 8
+BRUTE_FORCE_MAX_COMPARISONS = 10**8
+BRUTE_FORCE_BLOCK_SIZE = 2**22
+VPTREE_MAX_DISTANCE = 8
+PHASH_HASH_SIZE = 8
+PHASH_IMAGE_SIZE = 32
+JPEG_DRAFT_SIZE = 2 * PHASH_IMAGE_SIZE
+HASH_HEX_LENGTH = PHASH_HASH_SIZE * PHASH_HASH_SIZE // 4
+# LibRaw flip values mapped to the rotation postprocess() would apply
+RAW_FLIP_ROTATIONS = {3: cv2.ROTATE_180, 5: cv2.ROTATE_90_COUNTERCLOCKWISE, 6: cv2.ROTATE_90_CLOCKWISE}
+
+
+def file_extension(path: str) -> str:
+    # Plain string slicing, cheaper than Path.suffix or os.path.splitext for millions of files
+    dot = path.rfind(".")
+    if dot <= path.rfind(os.sep):
+        return ""
+    return path[dot:].lower()
+
+
+def file_size(path: str) -> int:
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def schedule_images(paths: Iterable[str]) -> list[str]:
+    # Longest processing time first: RAW files take far longer to decode than other images and larger files
+    # longer than smaller ones, so starting them early keeps workers from idling while a few big jobs finish
+    raw_paths = []
+    other_paths = []
+    for path in paths:
+        if file_extension(path) in RAW_EXTENSIONS:
+            raw_paths.append(path)
+        else:
+            other_paths.append(path)
 
+    raw_paths.sort(key=file_size, reverse=True)
+    other_paths.sort(key=file_size, reverse=True)
+    return raw_paths + other_paths
 
-def hash_images(hashes: ImageHashTable, paths: Iterable[Path], threads: int) -> ImageHashTable:
-    with ThreadPoolExecutor(max_workers=threads) as executor:
-        futures = {executor.submit(hash_image, path): path for path in paths}
-        for future in tqdm(as_completed(futures), total=len(futures), desc="Hashing images"):
-            result = future.result()
+
+def hash_images(hashes: ImageHashTable, paths: Iterable[str], threads: int) -> ImageHashTable:
+    scheduled_paths = schedule_images(paths)
+    # Send the paths in chunks to amortize the inter-process overhead, while keeping enough chunks per worker
+    # for the load to balance out
+    chunksize = max(1, len(scheduled_paths) // (threads * HASHING_CHUNKS_PER_WORKER))
+
+    # Hashing is CPU-bound, so use processes to not be limited by the GIL. Spawn them instead of forking, the VP-tree
+    # may be built on a background thread meanwhile and forking a multi-threaded process can deadlock the children.
+    with ProcessPoolExecutor(max_workers=threads, mp_context=multiprocessing.get_context("spawn")) as executor:
+        results = executor.map(hash_image, scheduled_paths, chunksize=chunksize)
+        for result in tqdm(results, total=len(scheduled_paths), desc="Hashing images"):
             if result:
                 image_hash, path = result
                 hashes[image_hash].add(path)
@@ -65,25 +158,82 @@ def hash_images(hashes: ImageHashTable, paths: Iterable[Path], threads: int) ->
     return hashes
 
 
-def hash_image(path: Path) -> tuple[imagehash.ImageHash, Path] | None:
-    ext = path.suffix.lower()
-    image = None
+def phash(pixels: np.ndarray) -> int:
+    if pixels.ndim == 3:
+        pixels = cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(pixels, (PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE), interpolation=cv2.INTER_AREA)
+    dct = cv2.dct(small.astype(np.float32))[:PHASH_HASH_SIZE, :PHASH_HASH_SIZE]
+
+    # cv2.dct is orthonormal, rescale the first row/column to match the unnormalized DCT used by imagehash.phash
+    dct[0, :] *= np.sqrt(2)
+    dct[:, 0] *= np.sqrt(2)
+
+    # Pack the bits row by row, most significant first, like imagehash does for its hex representation
+    return int.from_bytes(np.packbits(dct > np.median(dct)).tobytes(), "big")
+
+
+def hash_to_hex(image_hash: int) -> str:
+    return f"{image_hash:0{HASH_HEX_LENGTH}x}"
+
+
+def read_raw_thumbnail(raw: rawpy.RawPy) -> np.ndarray | None:
+    try:
+        thumb = raw.extract_thumb()
+    except (rawpy.LibRawNoThumbnailError, rawpy.LibRawUnsupportedThumbnailError):
+        return None
+
+    if thumb.format == rawpy.ThumbFormat.JPEG:
+        pixels = cv2.imdecode(
+            np.frombuffer(thumb.data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE | cv2.IMREAD_IGNORE_ORIENTATION
+        )
+    else:
+        pixels = thumb.data
+
+    if pixels is not None and raw.sizes.flip in RAW_FLIP_ROTATIONS:
+        pixels = cv2.rotate(pixels, RAW_FLIP_ROTATIONS[raw.sizes.flip])
+    return pixels
+
+
+def read_raw(path: str) -> np.ndarray:
+    with rawpy.imread(path) as raw:
+        # The embedded preview is plenty for a 32x32 hash and skips demosaicing entirely
+        pixels = read_raw_thumbnail(raw)
+        if pixels is None:
+            pixels = raw.postprocess(use_camera_wb=True, half_size=True)
+    return pixels
+
+
+def read_jpeg(path: str) -> np.ndarray:
+    with Image.open(path) as image:
+        # Let libjpeg decode straight to grayscale at the smallest DCT scale that is still large enough
+        image.draft("L", (JPEG_DRAFT_SIZE, JPEG_DRAFT_SIZE))
+        # Apply the EXIF orientation like cv2.imread does for the other formats, in place to avoid a copy
+        ImageOps.exif_transpose(image, in_place=True)
+        if image.mode == "L":
+            return np.asarray(image)
+        # libjpeg cannot convert every JPEG to grayscale while decoding, e.g. CMYK ones
+        return np.asarray(image.convert("L"))
+
+
+def hash_image(path: str) -> tuple[int, str] | None:
+    ext = file_extension(path)
     try:
-        if ext not in RAW_EXTENSIONS:
-            image = Image.open(path)
+        if ext in RAW_EXTENSIONS:
+            pixels = read_raw(path)
+        elif ext in JPEG_EXTENSIONS:
+            pixels = read_jpeg(path)
         else:
-            with rawpy.imread(path) as raw:
-                rgb = raw.postprocess(use_camera_wb=True, half_size=True)
-            image = Image.fromarray(rgb)
+            pixels = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+            if pixels is None:
+                # Fall back to PIL for formats OpenCV cannot decode
+                with Image.open(path) as image:
+                    pixels = np.asarray(image.convert("L"))
 
-        image_hash = imagehash.phash(image)
+        image_hash = phash(pixels)
         return image_hash, path
     except Exception:
         print(f"{path} - failed to read", file=sys.stderr)
         return None
-    finally:
-        if image:
-            image.close()
 
 
 def load_hashes(hashes: ImageHashTable, json_file: Path) -> ImageHashTable:
@@ -91,15 +241,39 @@ def load_hashes(hashes: ImageHashTable, json_file: Path) -> ImageHashTable:
         raw = json.load(f)
 
     try:
-        for image_hash_str, files in raw.items():
-            image_hash = imagehash.hex_to_hash(image_hash_str)
-            files_set = {Path(f) for f in files}
-            hashes[image_hash] = set(files_set)
+        # Decode all hashes in one go, every hash is a fixed-width big-endian 64-bit integer
+        if any(len(image_hash_str) != HASH_HEX_LENGTH for image_hash_str in raw):
+            raise ValueError
+        hex_hashes = "".join(raw.keys())
+        packed = np.frombuffer(bytes.fromhex(hex_hashes), dtype=">u8")
+        if len(packed) != len(raw):
+            raise ValueError
+
+        for image_hash, files in zip(packed.tolist(), raw.values()):
+            hashes[image_hash] = set(files)
     except ValueError:
         raise ValueError(f"Could not read JSON file '{str(json_file)}'")
     return hashes
 
 
+def walk_files(root: Path) -> Iterator[str]:
+    # os.scandir reuses the file type from the directory listing, so no extra stat per entry is needed
+    stack = [os.fspath(root)]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            # Skip unreadable or vanished directories like Path.rglob does
+            continue
+
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry.path
+
+
 def collect_hashes(paths: Iterable[Path], threads: int) -> ImageHashTable:
     hashes = ImageHashTable()
 
@@ -107,15 +281,18 @@ def collect_hashes(paths: Iterable[Path], threads: int) -> ImageHashTable:
     json_files = []
     image_files = []
     for path in paths:
-        items = path.rglob("*") if path.is_dir() else [path]
+        if path.is_dir():
+            items = walk_files(path)
+        elif path.is_file():
+            items = [os.fspath(path)]
+        else:
+            continue
 
         for item in items:
-            if not item.is_file():
-                continue
-
-            if item.suffix.lower() == ".json":
-                json_files.append(item)
-            else:
+            ext = file_extension(item)
+            if ext == ".json":
+                json_files.append(Path(item))
+            elif ext in IMAGE_EXTENSIONS:
                 image_files.append(item)
 
     # Process JSON files
@@ -129,27 +306,149 @@ def collect_hashes(paths: Iterable[Path], threads: int) -> ImageHashTable:
     return hashes
 
 
-def find_doppelgaenger(
+def hamming_distance(a: int, b: int) -> int:
+    # vptree stores its points in numpy arrays, so convert back to Python ints for the xor
+    return (int(a) ^ int(b)).bit_count()
+
+
+def find_doppelgaenger_exact(reference_hashes: ImageHashTable, target_hashes: ImageHashTable) -> DoppelgaengerList:
+    # Exact matches are a plain intersection of the hashes, walk the smaller table and look up in the larger one
+    if len(reference_hashes) <= len(target_hashes):
+        common_hashes = [h for h in reference_hashes.keys() if h in target_hashes]
+    else:
+        common_hashes = [h for h in target_hashes.keys() if h in reference_hashes]
+
+    doppelgaenger = DoppelgaengerList({})
+    for common_hash in common_hashes:
+        for reference_filename in reference_hashes[common_hash]:
+            doppelgaenger[reference_filename] = target_hashes[common_hash]
+
+    return doppelgaenger
+
+
+def find_doppelgaenger_brute_force(
     reference_hashes: ImageHashTable, target_hashes: ImageHashTable, max_distance: int
 ) -> DoppelgaengerList:
-    tree_hashes = list(target_hashes.keys())
-    tree = tree = vptree.VPTree(tree_hashes, lambda a, b: b - a)
+    reference_packed = reference_hashes.packed()
+    target_packed = target_hashes.packed()
+    reference_files = reference_hashes.files
+    target_files = target_hashes.files
+
+    # Bound the size of the distance matrix by comparing a block of references at a time
+    block_size = max(1, BRUTE_FORCE_BLOCK_SIZE // max(1, len(target_packed)))
 
     doppelgaenger = DoppelgaengerList({})
-    for reference_hash, reference_filenames in tqdm(reference_hashes.items(), desc="Searching for matches"):
-        matches = tree.get_all_in_range(reference_hash, max_distance + EPSILON)
+    with tqdm(total=len(reference_packed), desc="Searching for matches") as progress:
+        for start in range(0, len(reference_packed), block_size):
+            block = reference_packed[start : start + block_size]
+            distances = np.bitwise_count(np.bitwise_xor.outer(block, target_packed))
 
-        if matches:
-            all_matching_files = set()
-            for _, matched_hash in matches:
-                all_matching_files |= target_hashes[matched_hash]
+            matches = defaultdict(set)
+            for reference_index, target_index in zip(*np.nonzero(distances <= max_distance)):
+                matches[reference_index] |= target_files[target_index]
 
-            for reference_filename in reference_filenames:
-                doppelgaenger[reference_filename] = all_matching_files
+            for reference_index, all_matching_files in matches.items():
+                for reference_filename in reference_files[start + reference_index]:
+                    doppelgaenger[reference_filename] = all_matching_files
+
+            progress.update(len(block))
 
     return doppelgaenger
 
 
+def build_vptree(hashes: ImageHashTable) -> vptree.VPTree:
+    # Pass the uint64 array, vptree converts a list of Python ints >= 2**63 to float64 and loses the low bits
+    return vptree.VPTree(hashes.packed(), hamming_distance)
+
+
+class VPTreeBuildCancelled(Exception):
+    pass
+
+
+class BackgroundVPTree:
+    # Builds a VP-tree in a daemon thread. If the tree turns out to be unused, cancel() makes the build abort at its
+    # next distance computation, so it neither delays the exit nor competes with the search for the GIL.
+    def __init__(self, hashes: ImageHashTable) -> None:
+        self.__cancelled = False
+        self.__future: Future[vptree.VPTree] = Future()
+        threading.Thread(target=self.__build, args=(hashes,), daemon=True).start()
+
+    def __distance(self, a: int, b: int) -> int:
+        if self.__cancelled:
+            raise VPTreeBuildCancelled
+        return hamming_distance(a, b)
+
+    def __build(self, hashes: ImageHashTable) -> None:
+        try:
+            self.__future.set_result(vptree.VPTree(hashes.packed(), self.__distance))
+        except VPTreeBuildCancelled:
+            self.__future.cancel()
+        except Exception as e:
+            self.__future.set_exception(e)
+
+    def done(self) -> bool:
+        return self.__future.done()
+
+    def result(self) -> vptree.VPTree:
+        return self.__future.result()
+
+    def cancel(self) -> None:
+        self.__cancelled = True
+
+
+def search_vptree(tree: vptree.VPTree, query_hashes: ImageHashTable, max_distance: int) -> Iterator[tuple[int, int]]:
+    for query_hash in tqdm(query_hashes.keys(), total=len(query_hashes), desc="Searching for matches"):
+        for _, matched_hash in tree.get_all_in_range(query_hash, max_distance + EPSILON):
+            yield query_hash, int(matched_hash)
+
+
+def find_doppelgaenger_vptree(
+    reference_hashes: ImageHashTable,
+    target_hashes: ImageHashTable,
+    max_distance: int,
+    target_tree: BackgroundVPTree | None = None,
+) -> DoppelgaengerList:
+    # Build the tree over the smaller set, building costs O(n log n) while a query only costs O(log n).
+    # A target tree that was already built in the background is free, so it is used regardless.
+    matches = defaultdict(set)
+    if len(target_hashes) <= len(reference_hashes) or (target_tree is not None and target_tree.done()):
+        tree = target_tree.result() if target_tree is not None else build_vptree(target_hashes)
+        for reference_hash, target_hash in search_vptree(tree, reference_hashes, max_distance):
+            matches[reference_hash] |= target_hashes[target_hash]
+    else:
+        if target_tree is not None:
+            target_tree.cancel()
+        tree = build_vptree(reference_hashes)
+        for target_hash, reference_hash in search_vptree(tree, target_hashes, max_distance):
+            matches[reference_hash] |= target_hashes[target_hash]
+
+    doppelgaenger = DoppelgaengerList({})
+    for reference_hash, all_matching_files in matches.items():
+        for reference_filename in reference_hashes[reference_hash]:
+            doppelgaenger[reference_filename] = all_matching_files
+
+    return doppelgaenger
+
+
+def find_doppelgaenger(
+    reference_hashes: ImageHashTable,
+    target_hashes: ImageHashTable,
+    max_distance: int,
+    target_tree: BackgroundVPTree | None = None,
+) -> DoppelgaengerList:
+    if max_distance == 0:
+        return find_doppelgaenger_exact(reference_hashes, target_hashes)
+
+    # Large search radii make the VP-tree visit most of its nodes, so it only pays off for small distances
+    comparisons = len(reference_hashes) * len(target_hashes)
+    if comparisons <= BRUTE_FORCE_MAX_COMPARISONS or max_distance > VPTREE_MAX_DISTANCE:
+        if target_tree is not None:
+            target_tree.cancel()
+        return find_doppelgaenger_brute_force(reference_hashes, target_hashes, max_distance)
+
+    return find_doppelgaenger_vptree(reference_hashes, target_hashes, max_distance, target_tree)
+
+
 def get_cli_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Image hashing & duplicate finder tool.")
     subparsers = parser.add_subparsers(dest="command", required=True)
@@ -158,14 +457,14 @@ def get_cli_parser() -> argparse.ArgumentParser:
     hash_parser.add_argument(
         "-o", "--output", type=Path, help="Optional output file (JSON). If omitted, writes to stdout."
     )
-    hash_parser.add_argument("-t", "--threads", type=int, default=4, help="Number of worker threads (default: 4)")
+    hash_parser.add_argument("-t", "--threads", type=int, default=4, help="Number of worker processes (default: 4)")
     hash_parser.add_argument("inputs", nargs="+", type=Path, help="Folders/JSON files to compute the hashes for.")
 
     find_parser = subparsers.add_parser("find", help="Find Doppelgaenger.")
     find_parser.add_argument(
         "-o", "--output", type=Path, help="Optional output file (JSON). If omitted, writes to stdout."
     )
-    find_parser.add_argument("-t", "--threads", type=int, default=4, help="Number of worker threads (default: 4)")
+    find_parser.add_argument("-t", "--threads", type=int, default=4, help="Number of worker processes (default: 4)")
     find_parser.add_argument(
         "-d", "--distance", type=int, default=0, help="Max Hamming distance (default: 0 = exact match)"
     )
@@ -177,34 +476,53 @@ def get_cli_parser() -> argparse.ArgumentParser:
     return parser
 
 
-def json_encoder(obj: imagehash.ImageHash | Path | set) -> str | list:
-    if isinstance(obj, (imagehash.ImageHash, Path)):
-        return str(obj)
-    elif isinstance(obj, set):
+def json_encoder(obj: set) -> list:
+    if isinstance(obj, set):
         return list(obj)
     else:
         raise TypeError
 
 
-def handle_output(content: Any, dest: Path | None) -> None:
-    if isinstance(content, dict):
-        content = {str(k): v for k, v in content.items()}
+def stream_dump(items: Iterable[tuple[str, Any]], out: TextIO) -> None:
+    # Write the mapping entry by entry instead of building a stringified copy of it in memory
+    encoder = json.JSONEncoder(default=json_encoder)
+    out.write("{")
+    for i, (key, value) in enumerate(items):
+        if i:
+            out.write(", ")
+        out.write(encoder.encode(key))
+        out.write(": ")
+        out.write(encoder.encode(value))
+    out.write("}")
+
+
+def write_output(content: Any, out: TextIO) -> None:
+    if isinstance(content, ImageHashTable):
+        stream_dump(((hash_to_hex(k), v) for k, v in content.items()), out)
+    elif isinstance(content, dict):
+        stream_dump(content.items(), out)
+    else:
+        json.dump(content, out, default=json_encoder)
 
+
+def handle_output(content: Any, dest: Path | None) -> None:
     if dest:
         with open(dest, "w") as out:
-            json.dump(content, out, default=json_encoder)
+            write_output(content, out)
     else:
-        json.dump(content, sys.stdout, default=json_encoder)
+        write_output(content, sys.stdout)
 
 
 def output_hashes(reference_hashes: ImageHashTable, target_hashes: ImageHashTable, dest: Path) -> None:
+    if reference_hashes is target_hashes:
+        handle_output(target_hashes, dest)
+        return
+
     merged = ImageHashTable()
-    for k, v in reference_hashes.items():
-        merged[k] = v
-    for k, v in target_hashes.items():
-        merged[k] |= v
+    merged.update(reference_hashes)
+    merged.update(target_hashes)
 
-    handle_output(merged.hashes, dest)
+    handle_output(merged, dest)
 
 
 def main() -> None:
@@ -217,10 +535,19 @@ def main() -> None:
             output_hashes(target_hashes, target_hashes, args.output)
 
         elif args.command == "find":
-            reference_hashes = collect_hashes(args.reference, threads=args.threads)
+            # Collect the inputs first, so their VP-tree can be built in the background while the references are hashed
             target_hashes = collect_hashes(args.inputs, threads=args.threads)
-
-            doppelgaenger = find_doppelgaenger(reference_hashes, target_hashes, args.distance)
+            target_tree = None
+            if len(target_hashes) and 0 < args.distance <= VPTREE_MAX_DISTANCE:
+                target_tree = BackgroundVPTree(target_hashes)
+
+            try:
+                reference_hashes = collect_hashes(args.reference, threads=args.threads)
+                doppelgaenger = find_doppelgaenger(reference_hashes, target_hashes, args.distance, target_tree)
+            except BaseException:
+                if target_tree is not None:
+                    target_tree.cancel()
+                raise
 
             handle_output(doppelgaenger, args.output)
 
@@ -0,0 +1,85 @@
+import random
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import dedoppelgaenger  # noqa: E402
+
+
+def test_phash_matches_imagehash_layout() -> None:
+    # 32x32 input, so no resampling happens and the value equals imagehash.phash on the same pixels
+    y, x = np.mgrid[0:32, 0:32]
+    pixels = ((x * 7 + y * 13 + (x * y) % 17 * 5) % 256).astype(np.uint8)
+
+    image_hash = dedoppelgaenger.phash(pixels)
+
+    assert dedoppelgaenger.hash_to_hex(image_hash) == "c194c1953768b6ed"
+    assert dedoppelgaenger.phash(np.dstack([pixels] * 3)) == image_hash
+
+
+def test_hash_to_hex_is_zero_padded() -> None:
+    assert dedoppelgaenger.hash_to_hex(1) == "0000000000000001"
+    assert dedoppelgaenger.hash_to_hex(2**64 - 1) == "ffffffffffffffff"
+
+
+def make_hash_tables() -> tuple[dedoppelgaenger.ImageHashTable, dedoppelgaenger.ImageHashTable]:
+    rng = random.Random(0)
+    references = dedoppelgaenger.ImageHashTable()
+    targets = dedoppelgaenger.ImageHashTable()
+
+    target_hashes = [rng.getrandbits(64) for _ in range(2000)]
+    for i, target_hash in enumerate(target_hashes):
+        targets[target_hash].add(f"target{i}.jpg")
+
+    # Derive some references from the targets by flipping a few bits, so there is something to find
+    for i in range(300):
+        reference_hash = rng.choice(target_hashes) if i % 2 else rng.getrandbits(64)
+        for _ in range(rng.randint(0, 3)):
+            reference_hash ^= 1 << rng.randrange(64)
+        references[reference_hash].add(f"reference{i}.jpg")
+
+    return references, targets
+
+
+def normalize(doppelgaenger: dedoppelgaenger.DoppelgaengerList) -> dict[str, list[str]]:
+    return {k: sorted(v) for k, v in doppelgaenger.items()}
+
+
+@pytest.mark.parametrize("max_distance", [1, 2, 4, 8])
+@pytest.mark.parametrize("swap", [False, True])
+def test_vptree_matches_brute_force(max_distance: int, swap: bool) -> None:
+    references, targets = make_hash_tables()
+    if swap:
+        references, targets = targets, references
+
+    expected = dedoppelgaenger.find_doppelgaenger_brute_force(references, targets, max_distance)
+    actual = dedoppelgaenger.find_doppelgaenger_vptree(references, targets, max_distance)
+
+    assert expected
+    assert normalize(actual) == normalize(expected)
+
+
+def test_load_hashes_rejects_uneven_keys(tmp_path: Path) -> None:
+    json_file = tmp_path / "hashes.json"
+    json_file.write_text('{"ab848feeabc8d0": ["x"], "ab848feeabc8d05800": ["y"]}')
+
+    with pytest.raises(ValueError):
+        dedoppelgaenger.load_hashes(dedoppelgaenger.ImageHashTable(), json_file)
+
+
+def test_update_does_not_modify_source_tables() -> None:
+    first = dedoppelgaenger.ImageHashTable()
+    first[1].add("a.jpg")
+    second = dedoppelgaenger.ImageHashTable()
+    second[1].add("b.jpg")
+
+    merged = dedoppelgaenger.ImageHashTable()
+    merged.update(first)
+    merged.update(second)
+
+    assert merged[1] == {"a.jpg", "b.jpg"}
+    assert first[1] == {"a.jpg"}